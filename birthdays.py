@@ -20,14 +20,37 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import configparser
 import os
 import sys
 import argparse
 import csv
-from datetime import datetime
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
 from typing import Any, Tuple, List, Optional
 
+try:
+    from orjson import loads as json_loads, dumps as json_dumps
+except ImportError:  # orjson is optional, the standard library is just slower
+    from json import loads as json_loads, dumps as json_dumps
+
+# Number of concurrent PUT requests when updating birthdates
+MAX_WORKERS = 16
+
+# People per bulk update request, keeping the body well within the server's request size limit
+BATCH_SIZE = 500
+
+BIRTHDATE_RE = re.compile(r"([0-9]{4})-([0-9]{2})-([0-9]{2})")
+
+# Transient failures are retried with exponential backoff, honouring Retry-After on 429 and 503
+RETRY = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET", "PUT"], raise_on_status=False)
+
+# People per page when listing, the largest page size Immich accepts
+PAGE_SIZE = 1000
+
 
 def load_config() -> Tuple[str, str]:
     """Load Immich configuration from immich.ini or environment variables."""
@@ -48,32 +71,49 @@ def load_config() -> Tuple[str, str]:
     return IMMICH_URL, API_KEY
 
 
-def get_people_without_birthdate(IMMICH_URL: str, API_KEY: str) -> List[dict]:
-    headers = {
+def create_session(API_KEY: str) -> requests.Session:
+    """Create a keep-alive, retrying session for the Immich API, with room for every concurrent request."""
+    session = requests.Session()
+    # requests already asks for gzip/deflate responses and decompresses them transparently
+    session.headers.update({
         "Accept": "application/json",
         "x-api-key": API_KEY,
-    }
+    })
 
-    page = 1
-    size = 1000
-    results = []
+    # The default pool keeps 10 connections per host, fewer than the PUTs we run at once
+    adapter = HTTPAdapter(pool_maxsize=MAX_WORKERS, max_retries=RETRY)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
-    while True:
-        url = f"{IMMICH_URL}/api/people?withHidden=false&page={page}&size={size}"
-        resp = requests.get(url, headers=headers)
-        resp.raise_for_status()
-        data = resp.json()
 
-        people = data.get("people", [])
-        # Keep only those with a name and no birthDate
-        for person in people:
-            if person.get("name") and not person.get("birthDate"):
-                results.append(person)
+def get_people_without_birthdate(IMMICH_URL: str, API_KEY: str) -> List[dict]:
+    results = []
 
-        # Handle pagination
-        if not data.get("hasNextPage", False):
-            break
-        page += 1
+    with create_session(API_KEY) as session, ThreadPoolExecutor(max_workers=1) as executor:
+        def fetch_page(page: int) -> dict:
+            url = f"{IMMICH_URL}/api/people?withHidden=false&page={page}&size={PAGE_SIZE}"
+            resp = session.get(url)
+            resp.raise_for_status()
+            return json_loads(resp.content)
+
+        page = 1
+        future = executor.submit(fetch_page, page)
+        while future is not None:
+            data = future.result()
+
+            # Handle pagination, fetching the next page while we filter this one
+            if data.get("hasNextPage", False):
+                page += 1
+                future = executor.submit(fetch_page, page)
+            else:
+                future = None
+
+            people = data.get("people", [])
+            # Keep only those with a name and no birthDate; /api/people has no query filter for either
+            for person in people:
+                if person.get("name") and not person.get("birthDate"):
+                    results.append(person)
 
     return results
 
@@ -82,41 +122,77 @@ def validate_birthdate(date_str: Optional[str]) -> bool:
     """Return True if date_str is in YYYY-MM-DD format."""
     if not date_str:
         return False
+
+    # Check the shape with a regex, then let date() reject days that do not exist
+    match = BIRTHDATE_RE.fullmatch(date_str)
+    if not match:
+        return False
     try:
-        datetime.strptime(date_str, "%Y-%m-%d")
+        date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
         return True
-    except (ValueError, TypeError):
+    except ValueError:
         return False
 
 
 def update_birthdates(IMMICH_URL: str, API_KEY: str, rows: Any, silent: bool) -> None:
     """Update birthdays on Immich based on the rows passed"""
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/json",
-        "x-api-key": API_KEY,
-    }
-
-    for row in rows:
-        if not row or len(row) < 3:
-            continue  # skip empty or malformed lines
-
-        person_id, name, birthdate = [cell.strip() for cell in row]
-
-        if not validate_birthdate(birthdate):
-            if birthdate:
-                print(f"⚠ Skipping {name} ({person_id}): invalid birthdate '{birthdate}'", file=sys.stderr)
-            continue
-
-        url = f"{IMMICH_URL}/api/people/{person_id}"
-        payload = {"birthDate": birthdate}
-
-        resp = requests.put(url, headers=headers, json=payload)
-        if resp.status_code == 200:
-            if not silent:
-                print(f"✔ Updated {name} ({person_id}) with birthDate={birthdate}", file=sys.stderr)
-        else:
-            print(f"✖ Failed to update {name} ({person_id}): {resp.status_code} {resp.text}", file=sys.stderr)
+    with create_session(API_KEY) as session, ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # Open the connection to Immich while we are still reading the input, the response does not matter
+        executor.submit(session.get, f"{IMMICH_URL}/api/server/ping")
+
+        updates = []
+        for row in rows:
+            try:
+                person_id, name, birthdate = row[0].strip(), row[1].strip(), row[2].strip()
+            except IndexError:
+                continue  # skip empty or malformed lines
+
+            if not validate_birthdate(birthdate):
+                if birthdate:
+                    print(f"⚠ Skipping {name} ({person_id}): invalid birthdate '{birthdate}'", file=sys.stderr)
+                continue
+
+            updates.append((person_id, name, birthdate))
+
+        people_url = f"{IMMICH_URL}/api/people"
+        json_headers = {"Content-Type": "application/json"}
+
+        def put_batch(batch: List[Tuple[str, str, str]]) -> requests.Response:
+            payload = {"people": [{"id": person_id, "birthDate": birthdate} for person_id, name, birthdate in batch]}
+            return session.put(people_url, data=json_dumps(payload), headers=json_headers)
+
+        def put_birthdate(update: Tuple[str, str, str]) -> requests.Response:
+            person_id, name, birthdate = update
+            return session.put(f"{people_url}/{person_id}", data=json_dumps({"birthDate": birthdate}), headers=json_headers)
+
+        # Update people in bulk, a few batches at a time; results arrive in input order
+        batches = [updates[i:i + BATCH_SIZE] for i in range(0, len(updates), BATCH_SIZE)]
+        for batch, resp in zip(batches, executor.map(put_batch, batches)):
+            if resp.status_code in (400, 404, 405):
+                # Immich without the bulk endpoint, or one bad row failing validation of the whole batch:
+                # update every person independently, so only the bad rows fail
+                for (person_id, name, birthdate), resp in zip(batch, executor.map(put_birthdate, batch)):
+                    if resp.status_code == 200:
+                        if not silent:
+                            print(f"✔ Updated {name} ({person_id}) with birthDate={birthdate}", file=sys.stderr)
+                    else:
+                        print(f"✖ Failed to update {name} ({person_id}): {resp.status_code} {resp.text}", file=sys.stderr)
+                continue
+
+            if resp.status_code != 200:
+                for person_id, name, birthdate in batch:
+                    print(f"✖ Failed to update {name} ({person_id}): {resp.status_code} {resp.text}", file=sys.stderr)
+                continue
+
+            # The bulk endpoint reports success or an error code per person
+            results = {result["id"]: result for result in json_loads(resp.content)}
+            for person_id, name, birthdate in batch:
+                result = results.get(person_id, {})
+                if result.get("success"):
+                    if not silent:
+                        print(f"✔ Updated {name} ({person_id}) with birthDate={birthdate}", file=sys.stderr)
+                else:
+                    print(f"✖ Failed to update {name} ({person_id}): {result.get('error', 'unknown')}", file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -137,8 +213,7 @@ if __name__ == "__main__":
         output = open(args.file, "w", newline="", encoding="utf-8") if args.file else sys.stdout
         writer = csv.writer(output, delimiter=";")
         writer.writerow(["id", "name", "birthDate"])
-        for p in people_no_birthdate:
-            writer.writerow([p["id"], p["name"], ""])
+        writer.writerows([p["id"], p["name"], ""] for p in people_no_birthdate)
         if args.file:
             output.close()
 
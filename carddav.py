@@ -20,20 +20,43 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
 import csv
+import json
 import requests
-import vobject
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from xml.etree import ElementTree as ET
+from xml.sax.saxutils import escape
 import argparse
 from urllib.parse import urljoin
 import time
-from datetime import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from itertools import chain, islice
 import configparser
 import os
 import sys
 import re
-from typing import Tuple, List, Optional
+import tempfile
+from typing import Dict, Iterable, Iterator, Tuple, List, Optional
 
-NAMESPACES = {'D': 'DAV:', 'C': 'urn:ietf:params:xml:ns:carddav'}
+# Number of concurrent vCard requests to the CardDAV server
+MAX_WORKERS = 8
+
+# Number of vCards asked for in one addressbook-multiget REPORT
+MULTIGET_BATCH_SIZE = 200
+
+# Retried like the Immich requests in birthdays.py, for the read-only methods we send
+RETRY = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET", "PROPFIND", "REPORT"], raise_on_status=False)
+
+VCARD_FOLD_RE = re.compile(r"\r?\n[ \t]")
+
+VCARD_TEXT_ESCAPE_RE = re.compile(r"\\([\\,;nN])")
+
+# YYYY-MM-DD or YYYYMMDD, the separator must be used consistently
+BDAY_RE = re.compile(r"([0-9]{4})(-?)([0-9]{2})\2([0-9]{2})")
+
+NICKNAME_RE = re.compile(r"\s*\([^)]*\)")
 
 TRAILING_EMOJI_RE = re.compile(
     r"(?:\s*[\u2600-\u26FF"         # Misc Symbols (e.g., ⚰, ☀)
@@ -49,11 +72,89 @@ TRAILING_EMOJI_RE = re.compile(
 
 def clean_name(name: str) -> str:
     """Clean nickname parentheses and trailing emoji/symbols from a name."""
-    name = re.sub(r"\s*\([^)]*\)", "", name)
+    name = NICKNAME_RE.sub("", name)
     name = TRAILING_EMOJI_RE.sub("", name)
     return name.strip()
 
 
+class RateLimiter:
+    """Space out calls from any number of threads so they start at least interval seconds apart."""
+
+    def __init__(self, interval: Optional[float]) -> None:
+        # CARDDAV_SLEEP from the environment arrives as a string
+        self.interval = float(interval or 0)
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self) -> None:
+        if self.interval <= 0:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+class HrefTarget:
+    """XMLParser target collecting the vCard hrefs and ETags of a multi-status response while it is being fed.
+    The addressbook collection itself (ending in a slash) is skipped. ETags are None if the server sent none.
+    """
+
+    def __init__(self) -> None:
+        self.cards: List[Tuple[str, Optional[str]]] = []
+        self.href: Optional[str] = None
+        self.etag: Optional[str] = None
+        self.text: Optional[List[str]] = None
+
+    def start(self, tag: str, attrib: dict) -> None:
+        if tag == '{DAV:}response':
+            self.href = self.etag = None
+        elif tag in ('{DAV:}href', '{DAV:}getetag'):
+            self.text = []
+
+    def data(self, data: str) -> None:
+        if self.text is not None:
+            self.text.append(data)
+
+    def end(self, tag: str) -> None:
+        if tag == '{DAV:}href' and self.text is not None:
+            self.href = "".join(self.text).strip()
+            self.text = None
+        elif tag == '{DAV:}getetag' and self.text is not None:
+            self.etag = "".join(self.text).strip() or None
+            self.text = None
+        elif tag == '{DAV:}response' and self.href and not self.href.endswith('/'):
+            self.cards.append((self.href, self.etag))
+
+    def close(self) -> List[Tuple[str, Optional[str]]]:
+        return self.cards
+
+
+def parse_fn_bday(vcard_text: str) -> Tuple[Optional[str], Optional[str]]:
+    """Extract the FN and BDAY values from a vCard without parsing its other properties.
+    Returns None for a value that is not present.
+    """
+    fn = bday = None
+    # Unfold continuation lines before looking at the properties
+    for line in VCARD_FOLD_RE.sub("", vcard_text).splitlines():
+        prop, sep, value = line.partition(":")
+        if not sep:
+            continue
+
+        # Drop parameters and any property group ("item1.FN")
+        prop = prop.split(";", 1)[0].rsplit(".", 1)[-1].upper()
+        if prop == "FN" and fn is None:
+            fn = VCARD_TEXT_ESCAPE_RE.sub(lambda m: "\n" if m.group(1) in "nN" else m.group(1), value)
+        elif prop == "BDAY" and bday is None:
+            bday = value
+
+    return fn, bday
+
+
 def load_config() -> Tuple[Optional[str], Optional[str], Optional[str], Optional[float]]:
     """Load Immich configuration from immich.ini or environment variables."""
     config = configparser.ConfigParser()
@@ -67,30 +168,151 @@ def load_config() -> Tuple[Optional[str], Optional[str], Optional[str], Optional
     CARDDAV_URL = config.get("carddav", "url", fallback=os.environ.get("CARDDAV_URL"))
     CARDDAV_USER = config.get("carddav", "username", fallback=os.environ.get("CARDDAV_USER"))
     CARDDAV_PASS = config.get("carddav", "password", fallback=os.environ.get("CARDDAV_PASS"))
-    CARDDAV_SLEEP = config.getfloat("carddav", "sleep", fallback=os.environ.get("CARDDAV_SLEEP"))
+    CARDDAV_SLEEP = config.getfloat("carddav", "sleep", fallback=float(os.environ["CARDDAV_SLEEP"]) if os.environ.get("CARDDAV_SLEEP") else None)
 
     return CARDDAV_URL, CARDDAV_USER, CARDDAV_PASS, CARDDAV_SLEEP
 
 
+def create_session(username: str, password: str) -> requests.Session:
+    """Create a keep-alive, retrying session for the CardDAV server, with room for every concurrent request."""
+    session = requests.Session()
+    session.auth = (username, password)
+    adapter = HTTPAdapter(pool_maxsize=MAX_WORKERS, max_retries=RETRY)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def load_cache(cache_path: str, addressbook_url: str) -> Dict[str, list]:
+    """Load the vCards seen by a previous run, as {href: [etag, fn, bday]}.
+    Returns an empty cache if there is none, it is unreadable or it belongs to another addressbook.
+    """
+    try:
+        with open(cache_path, encoding="utf-8") as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+    if not isinstance(cache, dict) or cache.get("addressbook") != addressbook_url:
+        return {}
+
+    cards = cache.get("cards")
+    if not isinstance(cards, dict):
+        return {}
+
+    for entry in cards.values():
+        if not isinstance(entry, list) or len(entry) != 3 or not all(value is None or isinstance(value, str) for value in entry):
+            return {}
+
+    return cards
+
+
+def save_cache(cache_path: str, addressbook_url: str, cards: Dict[str, list]) -> None:
+    """Write the vCard cache, replacing the previous one atomically.
+    Failing to write it is only a warning, the next run just fetches every vCard again.
+    """
+    tmp_path = None
+    try:
+        # A unique file next to the cache, so concurrent runs do not write to the same temporary file
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=os.path.dirname(os.path.abspath(cache_path)),
+                                         prefix=".carddav_cache.", suffix=".tmp", delete=False) as cache_file:
+            tmp_path = cache_file.name
+            json.dump({"addressbook": addressbook_url, "cards": cards}, cache_file)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"⚠ Could not write cache {cache_path}: {e}", file=sys.stderr)
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
 def normalize_bday(bday: str) -> str | None:
     """Normalize birthday string to YYYY-MM-DD if in supported formats.
     Supported formats are: YYYY-MM-DD, YYYYMMDD.
     Returns None if unsupported format.
     """
-    bday = bday.strip()
-    for fmt in ("%Y%m%d", "%Y-%m-%d"):
-        try:
-            dt = datetime.strptime(bday, fmt)
-            if dt.year < 1900:  # Likely "X-APPLE-OMIT-YEAR" 1604 - stored date without year, cannot use
-                return None
-
-            return datetime.strptime(bday, fmt).strftime("%Y-%m-%d")
-        except ValueError:
+    match = BDAY_RE.fullmatch(bday.strip())
+    if not match:
+        return None  # unsupported format
+
+    year, _, month, day = match.groups()
+    if int(year) < 1900:  # Likely "X-APPLE-OMIT-YEAR" 1604 - stored date without year, cannot use
+        return None
+
+    try:
+        date(int(year), int(month), int(day))
+    except ValueError:
+        return None
+
+    return f"{year}-{month}-{day}"
+
+
+def fetch_vcards_multiget(session: requests.Session, addressbook_url: str, card_urls: List[str],
+                          limiter: RateLimiter) -> Tuple[List[Tuple[str, Optional[str], Optional[str]]], List[str]]:
+    """Fetch vCards with addressbook-multiget REPORTs (RFC 6352), as (href, FN, BDAY) tuples.
+    Every REPORT asks for at most MULTIGET_BATCH_SIZE vCards, starts when the limiter allows and is parsed while it arrives.
+    Returns the fetched vCards and the hrefs left unfetched because the server does not support the REPORT method or this report.
+    """
+    headers = {'Depth': '1', 'Content-Type': 'application/xml'}
+    vcards = []
+    for i in range(0, len(card_urls), MULTIGET_BATCH_SIZE):
+        hrefs = "".join(f"<D:href>{escape(card_url)}</D:href>" for card_url in card_urls[i:i + MULTIGET_BATCH_SIZE])
+        multiget_body = f'''<?xml version="1.0" encoding="UTF-8"?>
+<C:addressbook-multiget xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:carddav">
+  <D:prop><D:getetag/><C:address-data/></D:prop>
+  {hrefs}
+</C:addressbook-multiget>'''
+        limiter.wait()
+        with session.request('REPORT', addressbook_url, data=multiget_body, headers=headers, stream=True) as resp:
+            # 405/501 for servers without REPORT, 403 (DAV:supported-report) or 400 for servers without this report
+            if resp.status_code in (400, 403, 405, 501):
+                return vcards, card_urls[i:]
+            resp.raise_for_status()
+
+            # Only keep FN and BDAY of each response, dropping the vCard (and its photo) as soon as it is scanned
+            parser = ET.XMLPullParser(events=("end",))
+            for chunk in resp.iter_content(65536):
+                parser.feed(chunk)
+                vcards.extend(multiget_responses(parser))
+            parser.close()
+            vcards.extend(multiget_responses(parser))
+
+    return vcards, []
+
+
+def multiget_responses(parser: ET.XMLPullParser) -> Iterator[Tuple[str, Optional[str], Optional[str]]]:
+    """Yield (href, FN, BDAY) for every multi-status response the pull parser has completed so far."""
+    for _, elem in parser.read_events():
+        if elem.tag != '{DAV:}response':
             continue
-    return None  # unsupported format
 
+        href = elem.findtext('{DAV:}href')
+        vcard_text = elem.findtext('.//{urn:ietf:params:xml:ns:carddav}address-data')
+        if href and vcard_text:
+            yield (href.strip(), *parse_fn_bday(vcard_text))
+        elem.clear()
 
-def fetch_birthdates_from_carddav(rows: List[List[str]], url: str, username: str, password: str, sleep: float) -> List[List[str]]:
+
+def fetch_vcards_individually(session: requests.Session, url: str, card_urls: List[str],
+                              limiter: RateLimiter) -> Iterator[Tuple[str, Optional[str], Optional[str]]]:
+    """Fetch vCards one request per card, several at a time, each starting when the limiter allows.
+    Yields (href, FN, BDAY) tuples, scanned on the worker threads while other cards are still downloading.
+    """
+    def fetch_card(card_url: str) -> Tuple[str, Optional[str], Optional[str]]:
+        full_card_url = urljoin(url, card_url)  # DAV returns relative URLs (/dav/...)
+        limiter.wait()
+        card_resp = session.get(full_card_url)
+        card_resp.raise_for_status()
+        return (card_url, *parse_fn_bday(card_resp.text))
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        yield from executor.map(fetch_card, card_urls)
+
+
+def fetch_birthdates_from_carddav(rows: Iterable[List[str]], url: str, username: str, password: str, sleep: Optional[float],
+                                  cache_path: Optional[str] = None) -> List[List[str]]:
     # CardDAV addressbook URL
     addressbook_url = f"{url}/addressbooks/{username}/contacts/"
 
@@ -100,45 +322,63 @@ def fetch_birthdates_from_carddav(rows: List[List[str]], url: str, username: str
 <D:propfind xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:carddav">
   <D:prop><D:getetag/></D:prop>
 </D:propfind>'''
-    resp = requests.request('PROPFIND', addressbook_url, data=propfind_body, auth=(username, password), headers=headers)
-    resp.raise_for_status()
-    tree = ET.fromstring(resp.text)
-
-    # Extract vCard URLs
-    card_urls = []
-    for resp_elem in tree.findall('D:response', NAMESPACES):
-        href_elem = resp_elem.find('D:href', NAMESPACES)
-        if href_elem is not None:
-            card_urls.append(href_elem.text)
-
-    # Fetch every vCard and check for matches with our input
+    # Every request to the server starts at least sleep seconds after the previous one
+    limiter = RateLimiter(sleep)
+    with create_session(username, password) as session:
+        # Extract vCard URLs and ETags while the response is still arriving
+        limiter.wait()
+        with session.request('PROPFIND', addressbook_url, data=propfind_body, headers=headers, stream=True) as resp:
+            resp.raise_for_status()
+            parser = ET.XMLParser(target=HrefTarget())
+            for chunk in resp.iter_content(65536):
+                parser.feed(chunk)
+            cards = parser.close()
+
+        # Reuse FN and BDAY of every vCard whose ETag did not change since the last run, fetch the others
+        cache = load_cache(cache_path, addressbook_url) if cache_path else {}
+        parsed: Dict[str, Optional[Tuple[Optional[str], Optional[str]]]] = {}
+        card_urls = []
+        for href, etag in cards:
+            cached = cache.get(href)
+            if etag and cached and cached[0] == etag:
+                parsed[href] = (cached[1], cached[2])
+            else:
+                parsed[href] = None
+                card_urls.append(href)
+
+        # Fetch every changed vCard, one by one for those the server would not multiget
+        vcards, card_urls = fetch_vcards_multiget(session, addressbook_url, card_urls, limiter)
+        for href, vcard_name, vcard_bday in chain(vcards, fetch_vcards_individually(session, url, card_urls, limiter)):
+            parsed[href] = (vcard_name, vcard_bday)
+
+    # Only read our input now, so the requests above overlap with whoever is still writing it.
+    # Index it by lowercased name, the first row wins for duplicate names
+    index = {}
+    for row in rows:
+        name = row[1].strip()
+        index.setdefault(name.lower(), (row[0], name, row[2]))
+
+    # Check every vCard for matches with our input
     updated_rows = []
-    for card_url in card_urls:
-        full_card_url = urljoin(url, card_url)  # DAV returns relative URLs (/dav/...)
-        card_resp = requests.get(full_card_url, auth=(username, password))
-        card_resp.raise_for_status()
-        try:
-            vcard = vobject.readOne(card_resp.text)
-        except Exception:
+    for fn_bday in parsed.values():
+        if fn_bday is None:
             continue
 
-        vcard_name = getattr(vcard, 'fn', None)
-        vcard_bday = getattr(vcard, 'bday', None)
-        found_birthdate = None
-        for person_id, name, birthdate in rows:
-            name = name.strip()
-
-            vcard_clean_name = clean_name(vcard_name.value).lower()
+        vcard_name, vcard_bday = fn_bday
+        if not vcard_name or not vcard_bday:
+            continue
 
-            if vcard_name and vcard_clean_name == name.lower() and vcard_bday:
-                found_birthdate = normalize_bday(str(vcard_bday.value))
-                break
+        row = index.get(clean_name(vcard_name).lower())
+        if row is None:
+            continue
 
+        found_birthdate = normalize_bday(vcard_bday)
         if found_birthdate:
+            person_id, name, birthdate = row
             updated_rows.append([person_id, name, found_birthdate])
 
-        if sleep > 0:
-            time.sleep(sleep)
+    if cache_path:
+        save_cache(cache_path, addressbook_url, {href: [etag, *parsed[href]] for href, etag in cards if etag and parsed.get(href)})
 
     return updated_rows
 
@@ -150,7 +390,8 @@ if __name__ == "__main__":
     parser.add_argument("--url", required=False, help="CardDAV server URL")
     parser.add_argument("--username", required=False, help="CardDAV username")
     parser.add_argument("--password", required=False, help="CardDAV password")
-    parser.add_argument("--sleep", type=float, default=0, help="Seconds to sleep between requests to avoid rate-limiting")
+    parser.add_argument("--sleep", type=float, default=0, help="Minimum seconds between request starts to avoid rate-limiting")
+    parser.add_argument("--no-cache", action="store_true", help="Fetch every vCard, ignoring the ETag cache of the previous run")
     args = parser.parse_args()
 
     # Load configuration from INI, with environment variable fallback
@@ -176,15 +417,15 @@ if __name__ == "__main__":
     # Read input CSV, from specified file name or stdin
     input_file = open(args.input, newline="", encoding="utf-8") if args.input else sys.stdin
     reader = csv.reader(input_file, delimiter=";")
-    header = next(reader, None)  # skip header
-    rows = [row for row in reader if row and len(row) >= 3]
+    # Skip the header lazily too, so nothing waits for the input before the CardDAV requests are sent
+    rows = (row for row in islice(reader, 1, None) if row and len(row) >= 3)  # consumed once, while indexing
 
     # Go CardDAV!
-    updated_rows = fetch_birthdates_from_carddav(rows, CARDDAV_URL, CARDDAV_USER, CARDDAV_PASS, CARDDAV_SLEEP)
+    cache_path = None if args.no_cache else os.path.join(os.path.dirname(__file__), ".carddav_cache.json")
+    updated_rows = fetch_birthdates_from_carddav(rows, CARDDAV_URL, CARDDAV_USER, CARDDAV_PASS, CARDDAV_SLEEP, cache_path)
 
     # Write output CSV, to specified file name or stdout
     output = open(args.output, "w", newline="", encoding="utf-8") if args.output else sys.stdout
     writer = csv.writer(output, delimiter=";")
     writer.writerow(["id", "name", "birthDate"])
-    for row in updated_rows:
-        writer.writerow(row)
+    writer.writerows(updated_rows)
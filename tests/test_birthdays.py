@@ -7,18 +7,21 @@ import os
 # Add parent dir to path for import
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
-from birthdays import validate_birthdate, update_birthdates, load_config, get_people_without_birthdate
+from birthdays import validate_birthdate, update_birthdates, load_config, get_people_without_birthdate, create_session
 
 
 def test_validate_birthdate_valid():
     assert validate_birthdate("2020-01-15") is True
     assert validate_birthdate("1990-12-31") is True
+    assert validate_birthdate("2020-02-29") is True
 
 
 def test_validate_birthdate_invalid():
     assert validate_birthdate("2020-13-01") is False  # invalid month
     assert validate_birthdate("2020-01-32") is False  # invalid day
+    assert validate_birthdate("2021-02-29") is False  # not a leap year
     assert validate_birthdate("20-01-15") is False    # wrong format
+    assert validate_birthdate("2020-1-15") is False   # unpadded month
     assert validate_birthdate("not-a-date") is False
     assert validate_birthdate("") is False
     assert validate_birthdate(None) is False  # None input
@@ -36,13 +39,58 @@ def test_update_birthdates_skips_malformed_and_empty_rows():
     ]
 
     with requests_mock.Mocker() as m:
-        m.put("http://example.com/api/people/id4", json={}, status_code=200)
+        m.get("http://example.com/api/server/ping", json={"res": "pong"})
+        m.put("http://example.com/api/people", json=[{"id": "id4", "success": True}], status_code=200)
         # Should not raise, and only make one real API call
         update_birthdates("http://example.com", "dummykey", rows, silent=True)
 
-    # Only one PUT was made
-    assert len(m.request_history) == 1
-    assert m.request_history[0].url.endswith("/id4")
+    # Only one PUT was made, updating only the valid row
+    puts = [r for r in m.request_history if r.method == "PUT"]
+    assert len(puts) == 1
+    assert puts[0].headers["Content-Type"] == "application/json"
+    assert puts[0].json() == {"people": [{"id": "id4", "birthDate": "2023-05-01"}]}
+
+
+def test_update_birthdates_falls_back_to_single_puts(capsys):
+    """Servers without the bulk endpoint get one PUT per person, failures are reported per person."""
+    import requests_mock
+
+    rows = [["id1", "Alice", "1990-01-15"], ["id2", "Bob", "1985-06-30"]]
+
+    with requests_mock.Mocker() as m:
+        m.get("http://example.com/api/server/ping", json={"res": "pong"})
+        m.put("http://example.com/api/people", status_code=404)
+        m.put("http://example.com/api/people/id1", json={}, status_code=200)
+        m.put("http://example.com/api/people/id2", text="nope", status_code=400)
+        update_birthdates("http://example.com", "dummykey", rows, silent=False)
+
+    puts = sorted(r.url for r in m.request_history if r.method == "PUT")
+    assert puts == ["http://example.com/api/people", "http://example.com/api/people/id1", "http://example.com/api/people/id2"]
+    err = capsys.readouterr().err
+    assert "✔ Updated Alice (id1)" in err
+    assert "✖ Failed to update Bob (id2): 400 nope" in err
+
+
+def test_update_birthdates_retries_rejected_batch_per_person(capsys):
+    """A batch rejected as a whole because of one bad row is retried person by person."""
+    import requests_mock
+
+    rows = [["id1", "Alice", "1990-01-15"], ["bad-id", "Bob", "1985-06-30"], ["id3", "Charlie", "2001-02-03"]]
+
+    with requests_mock.Mocker() as m:
+        m.get("http://example.com/api/server/ping", json={"res": "pong"})
+        m.put("http://example.com/api/people", json={"message": ["people.1.id must be a UUID"]}, status_code=400)
+        m.put("http://example.com/api/people/id1", json={}, status_code=200)
+        m.put("http://example.com/api/people/bad-id", text="id must be a UUID", status_code=400)
+        m.put("http://example.com/api/people/id3", json={}, status_code=200)
+        update_birthdates("http://example.com", "dummykey", rows, silent=False)
+
+    err = capsys.readouterr().err
+    assert "✔ Updated Alice (id1)" in err
+    assert "✔ Updated Charlie (id3)" in err
+    assert "✖ Failed to update Bob (bad-id): 400 id must be a UUID" in err
+    assert "Failed to update Alice" not in err
+    assert "Failed to update Charlie" not in err
 
 
 def test_load_config_with_ini(tmp_path, monkeypatch):
@@ -111,3 +159,19 @@ def test_get_people_without_birthdate_filters_and_paginates():
     assert len(results) == 2
     assert results[0]["id"] == "p1"
     assert results[1]["id"] == "p4"
+    assert "gzip" in m.request_history[0].headers["Accept-Encoding"]
+
+
+def test_create_session_retries_transient_failures():
+    """The Immich session retries GET and PUT on transient statuses, with a pool for every worker."""
+    from birthdays import MAX_WORKERS
+
+    session = create_session("dummykey")
+    adapter = session.get_adapter("https://immich.test/")
+    assert session.headers["x-api-key"] == "dummykey"
+    assert adapter._pool_maxsize == MAX_WORKERS
+    assert adapter.max_retries.total == 5
+    assert set(adapter.max_retries.status_forcelist) == {429, 500, 502, 503, 504}
+    assert set(adapter.max_retries.allowed_methods) == {"GET", "PUT"}
+    assert adapter.max_retries.raise_on_status is False
+    assert session.get_adapter("http://immich.test/") is adapter
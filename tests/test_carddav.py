@@ -3,10 +3,12 @@
 import sys
 import os
 
+import pytest
+
 # Add parent dir to path for import
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
-from carddav import normalize_bday, load_config
+from carddav import normalize_bday, load_config, parse_fn_bday
 
 
 def test_normalize_bday_valid_formats():
@@ -19,6 +21,8 @@ def test_normalize_bday_unsupported_or_invalid():
     assert normalize_bday("2023/05/15") is None  # wrong separator
     assert normalize_bday("15-05-2023") is None  # wrong order
     assert normalize_bday("not-a-date") is None
+    assert normalize_bday("2023-0515") is None   # mixed separators
+    assert normalize_bday("20230230") is None    # no such day
     assert normalize_bday("") is None
 
 
@@ -28,6 +32,18 @@ def test_normalize_bday_old_year_omitted():
     assert normalize_bday("18001231") is None
 
 
+def test_parse_fn_bday():
+    vcard = (
+        "BEGIN:VCARD\r\nVERSION:3.0\r\nN:Turner;William;;;\r\n"
+        "PHOTO;ENCODING=b;TYPE=JPEG:/9j/4AAQ\r\n SkZJRgABAQ\r\n"
+        "fn:William Turner\\, Jr. (B\r\n ill)\r\n"
+        "BDAY;VALUE=date:1990-12-31\r\nEND:VCARD\r\n"
+    )
+    assert parse_fn_bday(vcard) == ("William Turner, Jr. (Bill)", "1990-12-31")
+    assert parse_fn_bday("BEGIN:VCARD\r\nFN:Alice\r\nEND:VCARD\r\n") == ("Alice", None)
+    assert parse_fn_bday("BEGIN:VCARD\r\nitem1.FN:Alice\r\nitem2.BDAY;VALUE=date:19900115\r\nEND:VCARD\r\n") == ("Alice", "19900115")
+
+
 def test_load_config_carddav_with_ini(tmp_path, monkeypatch):
     """carddav load_config reads from immich.ini when present."""
     ini = tmp_path / "immich.ini"
@@ -68,3 +84,262 @@ def test_name_cleaning_emoji_and_nickname():
     assert clean_name("Alice ⚰") == "Alice"
     assert clean_name("Bob 🇩🇪") == "Bob"
     assert clean_name("  Charlie (Chuck) 🎉  ") == "Charlie"
+
+
+PROPFIND_RESPONSE = """<?xml version="1.0" encoding="UTF-8"?>
+<D:multistatus xmlns:D="DAV:">
+  <D:response><D:href>/dav/addressbooks/me/contacts/</D:href></D:response>
+  <D:response><D:href>/dav/addressbooks/me/contacts/alice.vcf</D:href>
+    <D:propstat><D:prop><D:getetag>"1"</D:getetag></D:prop></D:propstat></D:response>
+  <D:response><D:href>/dav/addressbooks/me/contacts/bob.vcf</D:href>
+    <D:propstat><D:prop><D:getetag>"2"</D:getetag></D:prop></D:propstat></D:response>
+</D:multistatus>"""
+
+ALICE_VCARD = "BEGIN:VCARD\r\nVERSION:3.0\r\nFN:Alice (Al) 🎉\r\nN:;Alice;;;\r\nBDAY:19900115\r\nEND:VCARD\r\n"
+BOB_VCARD = "BEGIN:VCARD\r\nVERSION:3.0\r\nFN:Bob\r\nN:;Bob;;;\r\nEND:VCARD\r\n"
+
+MULTIGET_RESPONSE = f"""<?xml version="1.0" encoding="UTF-8"?>
+<D:multistatus xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:carddav">
+  <D:response>
+    <D:href>/dav/addressbooks/me/contacts/alice.vcf</D:href>
+    <D:propstat><D:prop><D:getetag>"1"</D:getetag><C:address-data>{ALICE_VCARD}</C:address-data></D:prop></D:propstat>
+  </D:response>
+  <D:response>
+    <D:href>/dav/addressbooks/me/contacts/bob.vcf</D:href>
+    <D:propstat><D:prop><D:getetag>"2"</D:getetag><C:address-data>{BOB_VCARD}</C:address-data></D:prop></D:propstat>
+  </D:response>
+</D:multistatus>"""
+
+
+def test_href_target_skips_collection():
+    """Hrefs and ETags are collected across feed() boundaries, the addressbook collection is skipped."""
+    from xml.etree import ElementTree as ET
+    from carddav import HrefTarget
+
+    parser = ET.XMLParser(target=HrefTarget())
+    data = PROPFIND_RESPONSE.encode()
+    for i in range(0, len(data), 7):
+        parser.feed(data[i:i + 7])
+    assert parser.close() == [("/dav/addressbooks/me/contacts/alice.vcf", '"1"'), ("/dav/addressbooks/me/contacts/bob.vcf", '"2"')]
+
+
+def test_fetch_birthdates_from_carddav_multiget():
+    """All vCards are fetched in one addressbook-multiget REPORT and matched by cleaned name."""
+    import requests_mock
+    from carddav import fetch_birthdates_from_carddav
+
+    rows = [["id1", "Alice", ""], ["id2", "Bob", ""], ["id3", "Charlie", ""]]
+    addressbook_url = "http://dav.test/dav/addressbooks/me/contacts/"
+
+    with requests_mock.Mocker() as m:
+        m.register_uri("PROPFIND", addressbook_url, text=PROPFIND_RESPONSE, status_code=207)
+        m.register_uri("REPORT", addressbook_url, text=MULTIGET_RESPONSE, status_code=207)
+
+        updated = fetch_birthdates_from_carddav(rows, "http://dav.test/dav", "me", "secret", 0)
+
+    assert updated == [["id1", "Alice", "1990-01-15"]]
+    assert [r.method for r in m.request_history] == ["PROPFIND", "REPORT"]
+    assert "/contacts/alice.vcf</D:href>" in m.request_history[1].text
+    assert "/contacts/</D:href>" not in m.request_history[1].text
+
+
+def test_fetch_birthdates_from_carddav_multiget_batches(monkeypatch):
+    """The multiget REPORT asks for a bounded number of vCards at a time."""
+    import requests_mock
+    import carddav
+
+    monkeypatch.setattr(carddav, "MULTIGET_BATCH_SIZE", 1)
+    rows = [["id1", "Alice", ""], ["id2", "Bob", ""]]
+    addressbook_url = "http://dav.test/dav/addressbooks/me/contacts/"
+
+    with requests_mock.Mocker() as m:
+        m.register_uri("PROPFIND", addressbook_url, text=PROPFIND_RESPONSE, status_code=207)
+        m.register_uri("REPORT", addressbook_url, text=MULTIGET_RESPONSE, status_code=207)
+
+        updated = carddav.fetch_birthdates_from_carddav(rows, "http://dav.test/dav", "me", "secret", 0)
+
+    assert updated == [["id1", "Alice", "1990-01-15"]]
+    reports = [r.text for r in m.request_history if r.method == "REPORT"]
+    assert len(reports) == 2
+    assert "/contacts/alice.vcf</D:href>" in reports[0] and "/contacts/bob.vcf</D:href>" not in reports[0]
+    assert "/contacts/bob.vcf</D:href>" in reports[1] and "/contacts/alice.vcf</D:href>" not in reports[1]
+
+
+def test_fetch_birthdates_from_carddav_paces_requests(monkeypatch):
+    """The sleep setting spaces out the PROPFIND and every multiget REPORT."""
+    import requests_mock
+    import carddav
+
+    clock = [100.0]
+    monkeypatch.setattr(carddav.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(carddav.time, "sleep", lambda seconds: clock.__setitem__(0, clock[0] + seconds))
+    monkeypatch.setattr(carddav, "MULTIGET_BATCH_SIZE", 1)
+    addressbook_url = "http://dav.test/dav/addressbooks/me/contacts/"
+    starts = []
+
+    def respond(text):
+        def callback(request, context):
+            starts.append(clock[0])
+            return text
+        return callback
+
+    with requests_mock.Mocker() as m:
+        m.register_uri("PROPFIND", addressbook_url, text=respond(PROPFIND_RESPONSE), status_code=207)
+        m.register_uri("REPORT", addressbook_url, text=respond(MULTIGET_RESPONSE), status_code=207)
+        carddav.fetch_birthdates_from_carddav([["id1", "Alice", ""]], "http://dav.test/dav", "me", "secret", 2.0)
+
+    assert [r.method for r in m.request_history] == ["PROPFIND", "REPORT", "REPORT"]
+    assert starts == [100.0, 102.0, 104.0]
+
+
+def test_fetch_birthdates_from_carddav_keeps_multiget_batches_before_fallback(monkeypatch):
+    """When a later multiget batch is refused, only the remaining vCards are fetched one by one."""
+    import requests_mock
+    import carddav
+
+    monkeypatch.setattr(carddav, "MULTIGET_BATCH_SIZE", 1)
+    rows = [["id1", "Alice", ""], ["id2", "Bob", ""]]
+    addressbook_url = "http://dav.test/dav/addressbooks/me/contacts/"
+    alice_only = MULTIGET_RESPONSE.split("<D:response>")
+    alice_only = "<D:response>".join(alice_only[:2]) + "</D:multistatus>"
+
+    with requests_mock.Mocker() as m:
+        m.register_uri("PROPFIND", addressbook_url, text=PROPFIND_RESPONSE, status_code=207)
+        m.register_uri("REPORT", addressbook_url, [{"text": alice_only, "status_code": 207}, {"status_code": 403}])
+        m.get("http://dav.test/dav/addressbooks/me/contacts/bob.vcf", text=BOB_VCARD.replace("END:VCARD", "BDAY:1985-06-30\r\nEND:VCARD"))
+
+        updated = carddav.fetch_birthdates_from_carddav(rows, "http://dav.test/dav", "me", "secret", 0)
+
+    assert updated == [["id1", "Alice", "1990-01-15"], ["id2", "Bob", "1985-06-30"]]
+    assert [r.method for r in m.request_history] == ["PROPFIND", "REPORT", "REPORT", "GET"]
+    assert m.request_history[3].url.endswith("/bob.vcf")
+
+
+@pytest.mark.parametrize("report_status", [400, 403, 405, 501])
+def test_fetch_birthdates_from_carddav_falls_back_to_get(report_status):
+    """Servers without REPORT or addressbook-multiget support get one GET per vCard."""
+    import requests_mock
+    from carddav import fetch_birthdates_from_carddav
+
+    rows = [["id1", "Alice", ""], ["id2", "Bob", ""]]
+    addressbook_url = "http://dav.test/dav/addressbooks/me/contacts/"
+
+    with requests_mock.Mocker() as m:
+        m.register_uri("PROPFIND", addressbook_url, text=PROPFIND_RESPONSE, status_code=207)
+        m.register_uri("REPORT", addressbook_url, status_code=report_status)
+        m.get("http://dav.test/dav/addressbooks/me/contacts/alice.vcf", text=ALICE_VCARD)
+        m.get("http://dav.test/dav/addressbooks/me/contacts/bob.vcf", text=BOB_VCARD)
+
+        updated = fetch_birthdates_from_carddav(rows, "http://dav.test/dav", "me", "secret", 0)
+
+    assert updated == [["id1", "Alice", "1990-01-15"]]
+    assert sorted(r.method for r in m.request_history) == ["GET", "GET", "PROPFIND", "REPORT"]
+
+
+def test_fetch_birthdates_from_carddav_etag_cache(tmp_path):
+    """A second run only fetches the vCards whose ETag changed, and still matches the cached ones."""
+    import requests_mock
+    from carddav import fetch_birthdates_from_carddav
+
+    rows = [["id1", "Alice", ""], ["id2", "Bob", ""]]
+    addressbook_url = "http://dav.test/dav/addressbooks/me/contacts/"
+    cache_path = str(tmp_path / "cache.json")
+
+    with requests_mock.Mocker() as m:
+        m.register_uri("PROPFIND", addressbook_url, text=PROPFIND_RESPONSE, status_code=207)
+        m.register_uri("REPORT", addressbook_url, text=MULTIGET_RESPONSE, status_code=207)
+        assert fetch_birthdates_from_carddav(rows, "http://dav.test/dav", "me", "secret", 0, cache_path) == [["id1", "Alice", "1990-01-15"]]
+
+    with requests_mock.Mocker() as m:
+        m.register_uri("PROPFIND", addressbook_url, text=PROPFIND_RESPONSE.replace('"2"', '"3"'), status_code=207)
+        m.register_uri("REPORT", addressbook_url, text=MULTIGET_RESPONSE, status_code=207)
+        updated = fetch_birthdates_from_carddav(rows, "http://dav.test/dav", "me", "secret", 0, cache_path)
+
+    assert updated == [["id1", "Alice", "1990-01-15"]]
+    assert "/contacts/alice.vcf</D:href>" not in m.request_history[1].text
+    assert "/contacts/bob.vcf</D:href>" in m.request_history[1].text
+
+
+def test_load_cache_ignores_corrupt_files(tmp_path):
+    """Caches of the wrong shape are ignored instead of crashing the run."""
+    import json
+    from carddav import load_cache
+
+    cache_path = tmp_path / "cache.json"
+    addressbook_url = "http://dav.test/dav/addressbooks/me/contacts/"
+    for cards in (["not", "a", "dict"], {"/a.vcf": "etag"}, {"/a.vcf": ['"1"', "Alice"]}, {"/a.vcf": ['"1"', 42, None]}):
+        cache_path.write_text(json.dumps({"addressbook": addressbook_url, "cards": cards}))
+        assert load_cache(str(cache_path), addressbook_url) == {}
+
+    cache_path.write_text("{not json")
+    assert load_cache(str(cache_path), addressbook_url) == {}
+
+    cards = {"/a.vcf": ['"1"', "Alice", None]}
+    cache_path.write_text(json.dumps({"addressbook": addressbook_url, "cards": cards}))
+    assert load_cache(str(cache_path), addressbook_url) == cards
+    assert load_cache(str(cache_path), "http://other.test/") == {}
+
+
+def test_save_cache_unwritable_warns(tmp_path, capsys):
+    """A cache that cannot be written is a warning, not an error."""
+    from carddav import save_cache, load_cache
+
+    save_cache(str(tmp_path / "missing" / "cache.json"), "http://dav.test/", {"/a.vcf": ['"1"', "Alice", None]})
+    assert "Could not write cache" in capsys.readouterr().err
+
+    cache_path = str(tmp_path / "cache.json")
+    save_cache(cache_path, "http://dav.test/", {"/a.vcf": ['"1"', "Alice", None]})
+    assert load_cache(cache_path, "http://dav.test/") == {"/a.vcf": ['"1"', "Alice", None]}
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["cache.json"]
+
+
+def test_create_session_retries_transient_failures():
+    """The CardDAV session retries the read-only methods on transient statuses."""
+    from carddav import create_session, MAX_WORKERS
+
+    session = create_session("me", "secret")
+    adapter = session.get_adapter("https://dav.test/")
+    assert session.auth == ("me", "secret")
+    assert adapter._pool_maxsize == MAX_WORKERS
+    assert adapter.max_retries.total == 5
+    assert set(adapter.max_retries.status_forcelist) == {429, 500, 502, 503, 504}
+    assert set(adapter.max_retries.allowed_methods) == {"GET", "PROPFIND", "REPORT"}
+    assert session.get_adapter("http://dav.test/") is adapter
+
+
+def test_rate_limiter_spaces_starts(monkeypatch):
+    """Consecutive calls start interval seconds apart, a missing or zero interval never sleeps."""
+    import carddav
+    from carddav import RateLimiter
+
+    clock = [100.0]
+    sleeps = []
+
+    def fake_sleep(seconds):
+        sleeps.append(seconds)
+        clock[0] += seconds
+
+    monkeypatch.setattr(carddav.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(carddav.time, "sleep", fake_sleep)
+
+    limiter = RateLimiter(1.0)
+    limiter.wait()  # first call starts immediately
+    limiter.wait()  # waits a full interval
+    clock[0] += 0.25
+    limiter.wait()  # only waits for the rest of the interval
+    clock[0] += 5
+    limiter.wait()  # idle long enough, starts immediately
+    assert sleeps == [1.0, 0.75]
+
+    sleeps.clear()
+    limiter = RateLimiter("0.5")  # as read from CARDDAV_SLEEP
+    limiter.wait()
+    limiter.wait()
+    assert sleeps == [0.5]
+
+    sleeps.clear()
+    for interval in (None, 0):
+        limiter = RateLimiter(interval)
+        limiter.wait()
+        limiter.wait()
+    assert sleeps == []